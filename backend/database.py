@@ -1,14 +1,33 @@
 """DuckDB database operations for storing extraction results"""
+import os
+import queue
+import tempfile
+import threading
+import blake3
 import duckdb
-import json
-import hashlib
+import orjson
+from cachetools import TTLCache
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterator
 from pathlib import Path
 
 
 DB_PATH = Path("extractions.duckdb")
 
+# Cursors share the database but each can be used from its own thread
+DB_POOL_SIZE = min(os.cpu_count() or 1, 8)
+
+# Saved extractions are immutable, so reads are memoized per extraction id.
+# Cached dicts are shared between callers and must be treated as read-only.
+_extraction_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_extraction_cache_lock = threading.Lock()
+
+# Filtered row counts for list_extractions, keyed by the filter values.
+# Any save clears it, so counts are only stale for writes from elsewhere.
+_count_cache: TTLCache = TTLCache(maxsize=256, ttl=60)
+_count_cache_lock = threading.Lock()
+
 
 def init_database() -> duckdb.DuckDBPyConnection:
     """Initialize database and create tables if they don't exist"""
@@ -50,10 +69,9 @@ def init_database() -> duckdb.DuckDBPyConnection:
         )
     """)
     
-    # Create index on doc_hash for fast deduplication lookups
-    conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_doc_hash ON extractions(doc_hash)
-    """)
+    # doc_hash lookups and ON CONFLICT (doc_hash) use the index behind the
+    # column's UNIQUE constraint; drop the redundant one older databases have
+    conn.execute("DROP INDEX IF EXISTS idx_doc_hash")
     
     # Create index on created_at for date range queries
     conn.execute("""
@@ -63,9 +81,53 @@ def init_database() -> duckdb.DuckDBPyConnection:
     return conn
 
 
+def create_cursor_pool(
+    conn: duckdb.DuckDBPyConnection,
+    size: int = DB_POOL_SIZE
+) -> "queue.Queue[duckdb.DuckDBPyConnection]":
+    """Create a pool of cursors on conn for use from worker threads"""
+    pool: "queue.Queue[duckdb.DuckDBPyConnection]" = queue.Queue()
+    for _ in range(size):
+        pool.put(conn.cursor())
+    return pool
+
+
+@contextmanager
+def pooled_cursor(pool: "queue.Queue[duckdb.DuckDBPyConnection]") -> Iterator[duckdb.DuckDBPyConnection]:
+    """Borrow a cursor from the pool, blocking until one is free"""
+    cursor = pool.get()
+    try:
+        yield cursor
+    finally:
+        pool.put(cursor)
+
+
+def close_cursor_pool(pool: "queue.Queue[duckdb.DuckDBPyConnection]") -> None:
+    """Close every cursor currently in the pool"""
+    while not pool.empty():
+        pool.get_nowait().close()
+
+
 def generate_doc_hash(file_bytes: bytes) -> str:
-    """Generate SHA-256 hash of document for deduplication"""
-    return hashlib.sha256(file_bytes).hexdigest()
+    """
+    Generate BLAKE3 hash of document for deduplication
+
+    Dedup only needs collision resistance; BLAKE3's SIMD tree hashing is
+    several times faster than SHA-256. The 256-bit hex digest keeps the
+    stored value the same width as the previous SHA-256 hashes. Large
+    inputs are also split across threads (AUTO leaves small ones serial).
+    """
+    return blake3.blake3(file_bytes, max_threads=blake3.blake3.AUTO).hexdigest()
+
+
+def new_doc_hasher() -> blake3.blake3:
+    """Create an incremental hasher producing the same digest as generate_doc_hash"""
+    return blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+
+def hash_backend_info() -> str:
+    """Describe the hash implementation used for deduplication"""
+    return f"blake3 {blake3.__version__}"
 
 
 def save_extraction(
@@ -76,14 +138,73 @@ def save_extraction(
     extracted_data: Dict[str, Any],
     confidence: float = 1.0
 ) -> str:
-    """Save extraction result to database"""
-    # Insert extraction
-    conn.execute("""
+    """
+    Save extraction result and its line items in a single transaction
+
+    Returns the id stored for doc_hash. If another request already saved
+    the same document, nothing is written and the existing id is returned,
+    so callers can detect the duplicate by comparing it to extraction_id.
+    """
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        inserted = _insert_extraction(conn, extraction_id, doc_hash, filename, extracted_data, confidence)
+        if inserted:
+            _insert_line_items(conn, extraction_id, extracted_data.get("lineItems", []))
+            stored_id = extraction_id
+        else:
+            stored_id = _find_id_by_hash(conn, doc_hash)
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    
+    try:
+        conn.execute("COMMIT")
+    except duckdb.TransactionException:
+        # A failed COMMIT has already ended the transaction, so there is
+        # nothing to roll back. ON CONFLICT only sees committed rows: if a
+        # concurrent save of the same document committed after our INSERT,
+        # ours fails the unique check here, and theirs is the duplicate.
+        stored_id = _find_id_by_hash(conn, doc_hash)
+        if stored_id is None or stored_id == extraction_id:
+            raise
+
+    with _extraction_cache_lock:
+        _extraction_cache.pop(extraction_id, None)
+    with _count_cache_lock:
+        _count_cache.clear()
+
+    return stored_id
+
+
+def _find_id_by_hash(conn: duckdb.DuckDBPyConnection, doc_hash: str) -> Optional[str]:
+    """Return the id stored for doc_hash, if any"""
+    row = conn.execute("""
+        SELECT id FROM extractions WHERE doc_hash = ?
+    """, [doc_hash]).fetchone()
+    return row[0] if row else None
+
+
+def _insert_extraction(
+    conn: duckdb.DuckDBPyConnection,
+    extraction_id: str,
+    doc_hash: str,
+    filename: str,
+    extracted_data: Dict[str, Any],
+    confidence: float
+) -> bool:
+    """
+    Insert the extraction row unless doc_hash already exists
+
+    Returns True if a row was inserted. The caller owns the transaction.
+    """
+    row = conn.execute("""
         INSERT INTO extractions (
             id, doc_hash, filename, document_type, vendor_name,
             total_amount, currency, date, due_date, tax_amount,
             invoice_number, vendor_address, summary, raw_json, confidence
         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (doc_hash) DO NOTHING
+        RETURNING id
     """, [
         extraction_id,
         doc_hash,
@@ -98,74 +219,99 @@ def save_extraction(
         extracted_data.get("invoiceNumber", ""),
         extracted_data.get("vendorAddress"),
         extracted_data.get("summary"),
-        json.dumps(extracted_data),
+        orjson.dumps(extracted_data).decode("utf-8"),
         confidence
-    ])
-    
-    # Insert line items
-    line_items = extracted_data.get("lineItems", [])
-    for idx, item in enumerate(line_items):
-        line_item_id = f"{extraction_id}_line_{idx}"
-        conn.execute("""
-            INSERT INTO line_items (
-                id, extraction_id, description, quantity,
-                unit_price, total, sku
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, [
-            line_item_id,
+    ]).fetchone()
+    return row is not None
+
+
+def _insert_line_items(
+    conn: duckdb.DuckDBPyConnection,
+    extraction_id: str,
+    line_items: List[Dict[str, Any]]
+) -> None:
+    """Insert line items in a single batched statement (caller owns the transaction)"""
+    rows = [
+        [
+            f"{extraction_id}_line_{idx}",
             extraction_id,
             item.get("description", ""),
             item.get("quantity", 0.0),
             item.get("unitPrice", 0.0),
             item.get("total", 0.0),
             item.get("sku")
-        ])
-    
-    return extraction_id
+        ]
+        for idx, item in enumerate(line_items)
+    ]
+    if rows:
+        conn.executemany("""
+            INSERT INTO line_items (
+                id, extraction_id, description, quantity,
+                unit_price, total, sku
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
 
 
 def get_extraction(conn: duckdb.DuckDBPyConnection, extraction_id: str) -> Optional[Dict[str, Any]]:
     """Get extraction by ID with line items"""
+    with _extraction_cache_lock:
+        cached = _extraction_cache.get(extraction_id)
+    if cached is not None:
+        return cached
+    
+    # Line items are aggregated into a list of structs by DuckDB so the
+    # whole document comes back in a single round-trip
     result = conn.execute("""
-        SELECT * FROM extractions WHERE id = ?
+        SELECT
+            e.id, e.document_type, e.vendor_name, e.total_amount, e.currency,
+            e.date, e.due_date, e.tax_amount, e.invoice_number,
+            e.vendor_address, e.summary,
+            (
+                SELECT LIST({
+                    'description': l.description,
+                    'quantity': l.quantity,
+                    'unit_price': l.unit_price,
+                    'total': l.total,
+                    'sku': l.sku
+                } ORDER BY l.id)
+                FROM line_items l
+                WHERE l.extraction_id = e.id
+            ) AS line_items
+        FROM extractions e
+        WHERE e.id = ?
     """, [extraction_id]).fetchone()
     
     if not result:
         return None
     
-    # Get line items
-    line_items = conn.execute("""
-        SELECT description, quantity, unit_price, total, sku
-        FROM line_items
-        WHERE extraction_id = ?
-        ORDER BY id
-    """, [extraction_id]).fetchall()
-    
     # Reconstruct extraction data
     extraction = {
         "id": result[0],
-        "documentType": result[3],
-        "vendorName": result[4],
-        "totalAmount": float(result[5]) if result[5] else 0.0,
-        "currency": result[6],
-        "date": result[7].isoformat() if result[7] else None,
-        "dueDate": result[8].isoformat() if result[8] else None,
-        "taxAmount": float(result[9]) if result[9] else 0.0,
-        "invoiceNumber": result[10],
-        "vendorAddress": result[11],
-        "summary": result[12],
+        "documentType": result[1],
+        "vendorName": result[2],
+        "totalAmount": float(result[3]) if result[3] else 0.0,
+        "currency": result[4],
+        "date": result[5].isoformat() if result[5] else None,
+        "dueDate": result[6].isoformat() if result[6] else None,
+        "taxAmount": float(result[7]) if result[7] else 0.0,
+        "invoiceNumber": result[8],
+        "vendorAddress": result[9],
+        "summary": result[10],
         "lineItems": [
             {
-                "description": item[0],
-                "quantity": float(item[1]) if item[1] else 0.0,
-                "unitPrice": float(item[2]) if item[2] else 0.0,
-                "total": float(item[3]) if item[3] else 0.0,
-                "sku": item[4]
+                "description": item["description"],
+                "quantity": float(item["quantity"]) if item["quantity"] else 0.0,
+                "unitPrice": float(item["unit_price"]) if item["unit_price"] else 0.0,
+                "total": float(item["total"]) if item["total"] else 0.0,
+                "sku": item["sku"]
             }
-            for item in line_items
+            for item in result[11] or []
         ]
     }
     
+    with _extraction_cache_lock:
+        _extraction_cache[extraction_id] = extraction
+    
     return extraction
 
 
@@ -187,9 +333,22 @@ def list_extractions(
     vendor: Optional[str] = None,
     doc_type: Optional[str] = None,
     offset: int = 0,
-    limit: int = 100
-) -> tuple[List[Dict[str, Any]], int]:
-    """List extractions with filters and pagination"""
+    limit: int = 100,
+    cursor_created_at: Optional[datetime] = None,
+    cursor_id: Optional[str] = None,
+    include_total: bool = True
+) -> tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    List extractions with filters and pagination
+
+    Pages are ordered newest first by (created_at, id). Passing the
+    createdAt/id of the last row of a page as cursor_created_at/cursor_id
+    returns the next page via a keyset seek, which stays fast at any
+    depth; offset is still honoured for callers that page by position.
+
+    The total matching count is cached per filter for a minute; with
+    include_total=False it is skipped entirely and returned as None.
+    """
     conditions = []
     params = []
     
@@ -209,10 +368,26 @@ def list_extractions(
     where_clause = " AND ".join(conditions) if conditions else "1=1"
     
     # Get total count
-    count_result = conn.execute(f"""
-        SELECT COUNT(*) FROM extractions WHERE {where_clause}
-    """, params).fetchone()
-    total = count_result[0] if count_result else 0
+    total = None
+    if include_total:
+        count_key = (date_from, date_to, vendor, doc_type)
+        with _count_cache_lock:
+            total = _count_cache.get(count_key)
+        if total is None:
+            count_result = conn.execute(f"""
+                SELECT COUNT(*) FROM extractions WHERE {where_clause}
+            """, params).fetchone()
+            total = count_result[0] if count_result else 0
+            with _count_cache_lock:
+                _count_cache[count_key] = total
+    
+    # Seek past the cursor row instead of scanning and discarding offset rows
+    if cursor_created_at and cursor_id:
+        where_clause += """
+            AND (created_at < ?
+                 OR (created_at = ? AND id < ?))
+        """
+        params.extend([cursor_created_at, cursor_created_at, cursor_id])
     
     # Get paginated results
     params.extend([limit, offset])
@@ -221,7 +396,7 @@ def list_extractions(
                currency, date, created_at
         FROM extractions
         WHERE {where_clause}
-        ORDER BY created_at DESC
+        ORDER BY created_at DESC, id DESC
         LIMIT ? OFFSET ?
     """, params).fetchall()
     
@@ -242,43 +417,68 @@ def list_extractions(
     return extractions, total
 
 
-def export_to_csv(conn: duckdb.DuckDBPyConnection, extraction_ids: Optional[List[str]] = None) -> bytes:
-    """Export extractions to CSV format"""
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+
+def _export_query(extraction_ids: Optional[List[str]] = None) -> tuple[str, List[str]]:
+    """Build the export query and its parameters"""
+    where_clause = ""
+    params: List[str] = []
     if extraction_ids:
         placeholders = ",".join(["?"] * len(extraction_ids))
-        query = f"""
-            SELECT 
-                e.id, e.filename, e.document_type, e.vendor_name,
-                e.total_amount, e.currency, e.date, e.invoice_number,
-                e.tax_amount, e.summary,
-                l.description, l.quantity, l.unit_price, l.total, l.sku
-            FROM extractions e
-            LEFT JOIN line_items l ON e.id = l.extraction_id
-            WHERE e.id IN ({placeholders})
-            ORDER BY e.id, l.id
-        """
-        result = conn.execute(query, extraction_ids)
-    else:
-        result = conn.execute("""
-            SELECT 
-                e.id, e.filename, e.document_type, e.vendor_name,
-                e.total_amount, e.currency, e.date, e.invoice_number,
-                e.tax_amount, e.summary,
-                l.description, l.quantity, l.unit_price, l.total, l.sku
-            FROM extractions e
-            LEFT JOIN line_items l ON e.id = l.extraction_id
-            ORDER BY e.id, l.id
-        """)
-    
-    # Convert to CSV
-    csv_lines = []
-    csv_lines.append("id,filename,document_type,vendor_name,total_amount,currency,date,invoice_number,tax_amount,summary,line_description,line_quantity,line_unit_price,line_total,line_sku")
+        where_clause = f"WHERE e.id IN ({placeholders})"
+        params = list(extraction_ids)
     
-    for row in result.fetchall():
-        csv_line = ",".join([
-            str(val).replace(",", ";") if val is not None else ""
-            for val in row
-        ])
-        csv_lines.append(csv_line)
-    
-    return "\n".join(csv_lines).encode("utf-8")
+    query = f"""
+        SELECT 
+            e.id AS id, e.filename AS filename, e.document_type AS document_type,
+            e.vendor_name AS vendor_name, e.total_amount AS total_amount,
+            e.currency AS currency, e.date AS date, e.invoice_number AS invoice_number,
+            e.tax_amount AS tax_amount, e.summary AS summary,
+            l.description AS line_description, l.quantity AS line_quantity,
+            l.unit_price AS line_unit_price, l.total AS line_total, l.sku AS line_sku
+        FROM extractions e
+        LEFT JOIN line_items l ON e.id = l.extraction_id
+        {where_clause}
+        ORDER BY e.id, l.id
+    """
+    return query, params
+
+
+def iter_csv_export(
+    conn: duckdb.DuckDBPyConnection,
+    extraction_ids: Optional[List[str]] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Stream extractions as CSV chunks
+
+    DuckDB's COPY writes the CSV (with RFC 4180 quoting) to a temporary
+    file using its native writer; the file is then streamed back in
+    chunk_size pieces and removed. The COPY runs on its own cursor so it
+    doesn't clobber results of other statements on the shared connection.
+    """
+    query, params = _export_query(extraction_ids)
+    fd, export_path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        cursor = conn.cursor()
+        try:
+            quoted_path = export_path.replace("'", "''")
+            cursor.execute(
+                f"COPY ({query}) TO '{quoted_path}' (FORMAT CSV, HEADER)",
+                params
+            )
+        finally:
+            cursor.close()
+        
+        with open(export_path, "rb") as export_file:
+            while chunk := export_file.read(chunk_size):
+                yield chunk
+    finally:
+        os.remove(export_path)
+
+
+def export_to_csv(conn: duckdb.DuckDBPyConnection, extraction_ids: Optional[List[str]] = None) -> bytes:
+    """Export extractions to CSV format"""
+    return b"".join(iter_csv_export(conn, extraction_ids))
@@ -1,8 +1,13 @@
 """LLM extraction module using local Ollama"""
-import json
-import base64
-from typing import Dict, Any, List
+import asyncio
+import hashlib
+import os
+import re
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple, Union
 import ollama
+import orjson
+from cachetools import LRUCache
 from .models import ExtractedData, DocumentType
 
 
@@ -40,58 +45,159 @@ Rules:
 4. Output ONLY the valid JSON string. Do not include markdown formatting like ```json.
 """
 
+# Maximum concurrent requests to the Ollama server (GPU concurrency)
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "2"))
+_llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+OLLAMA_MODEL = "qwen3-vl"
+# Most page images sent with one extraction request
+OLLAMA_MAX_IMAGES = int(os.environ.get("OLLAMA_MAX_IMAGES", "8"))
+
+# Results of identical (model, prompt, images) requests; opt-in with
+# LLM_CACHE_ENABLED=1 since it replays one sample instead of re-asking
+LLM_CACHE_SIZE = 256
+_LLM_CACHE: LRUCache = LRUCache(maxsize=LLM_CACHE_SIZE)
+
+
+def _llm_cache_enabled() -> bool:
+    """Check the opt-in flag (read per call so it can be toggled at runtime)"""
+    return os.environ.get("LLM_CACHE_ENABLED") == "1"
+
+
+def _llm_cache_key(provider: str, model: str, prompt: str, images: List[str]) -> str:
+    """
+    Hash the request fields, NUL-separated so boundaries can't collide
+
+    Fields are fed to the hasher one at a time rather than serialized into
+    one payload, which would copy every multi-MB page image; a 128-bit
+    BLAKE2b digest is plenty for a cache key and cheaper than SHA-256.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in (provider, model, prompt, *images):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+# Fields scored by calculate_confidence: each required field is an equal
+# share of the base score, each bonus field adds CONFIDENCE_BONUS
+REQUIRED_FIELDS = ("vendorName", "totalAmount", "date")
+BONUS_FIELDS = ("lineItems", "invoiceNumber")
+CONFIDENCE_BONUS = 0.1
+
+# Bit i of a field mask is set iff field i (required fields first) is present
+FIELD_BITS = {
+    field: 1 << i for i, field in enumerate(REQUIRED_FIELDS + BONUS_FIELDS)
+}
+REQUIRED_MASK = (1 << len(REQUIRED_FIELDS)) - 1
+
+
+def confidence_field_mask(extracted_data: Dict[str, Any]) -> int:
+    """Bitmask of scored fields that are present and truthy (see FIELD_BITS)"""
+    mask = 0
+    for field, bit in FIELD_BITS.items():
+        if extracted_data.get(field):
+            mask |= bit
+    return mask
+
 
 def calculate_confidence(extracted_data: Dict[str, Any]) -> float:
     """Calculate confidence score based on required fields"""
-    required_fields = ["vendorName", "totalAmount", "date"]
-    present_fields = sum(1 for field in required_fields if extracted_data.get(field))
+    mask = confidence_field_mask(extracted_data)
     
-    base_score = present_fields / len(required_fields)
+    base_score = (mask & REQUIRED_MASK).bit_count() / len(REQUIRED_FIELDS)
     
-    # Bonus for having line items
-    if extracted_data.get("lineItems"):
-        base_score += 0.1
-    
-    # Bonus for having invoice number
-    if extracted_data.get("invoiceNumber"):
-        base_score += 0.1
+    # Bonus for having line items / invoice number
+    for field in BONUS_FIELDS:
+        if mask & FIELD_BITS[field]:
+            base_score += CONFIDENCE_BONUS
     
     return min(base_score, 1.0)
 
 
+# JSON string literals (with escapes) or braces; strings are matched whole
+# so braces inside them are never counted. The closing quote is optional so
+# an unterminated string consumes the rest of the text in one match instead
+# of failing and being retried from every later quote (quadratic)
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"?|[{}]')
+
+
+def _find_json_span(text: str) -> Optional[Tuple[int, int]]:
+    """Return (start, end) of the first balanced top-level JSON object in text"""
+    start = text.find("{")
+    if start == -1:
+        return None
+    
+    depth = 0
+    for match in _JSON_TOKEN.finditer(text, start):
+        token = match.group()
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if depth == 0:
+                return start, match.end()
+    return None
+
+
 def parse_json_response(text: str) -> Dict[str, Any]:
-    """Parse JSON from LLM response, handling markdown code blocks"""
-    # Remove markdown code blocks if present
-    if "```" in text:
-        text = text.replace("```json", "").replace("```", "")
+    """Parse JSON from LLM response, handling markdown code blocks and surrounding text"""
+    # Fast path: the prompt asks for a bare JSON object, which is the common
+    # case; any other JSON value (e.g. an array around the object) falls
+    # through to the brace slice
+    try:
+        parsed = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        parsed = None
+    if isinstance(parsed, dict):
+        return parsed
     
-    # Find JSON object bounds
+    # Fences or prose around a single object: slice from the outer braces
     first_brace = text.find("{")
     last_brace = text.rfind("}")
+    if first_brace != -1 and last_brace > first_brace:
+        try:
+            return orjson.loads(text[first_brace:last_brace + 1])
+        except orjson.JSONDecodeError:
+            pass
     
-    if first_brace != -1 and last_brace != -1:
-        text = text[first_brace:last_brace + 1]
+    # Stray braces after the object: scan for the first balanced object
+    span = _find_json_span(text)
+    if span is None:
+        raise ValueError("Failed to parse JSON response: no JSON object found")
     
     try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
+        return orjson.loads(text[span[0]:span[1]])
+    except orjson.JSONDecodeError as e:
         raise ValueError(f"Failed to parse JSON response: {e}")
 
 
 async def ollama_extract(images: List[str], prompt: str = EXTRACTION_PROMPT) -> Dict[str, Any]:
     """Extract data using local Ollama Qwen2-VL model"""
+    # All pages go in one message so the model sees the whole document in a
+    # single round trip; very long documents are truncated to bound context
+    sent_images = images[:OLLAMA_MAX_IMAGES]
+    cache_key = None
+    if _llm_cache_enabled():
+        cache_key = _llm_cache_key("ollama", OLLAMA_MODEL, prompt, sent_images)
+        cached = _LLM_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+    
     try:
         # Ollama vision models expect images as base64 strings
-        # For Qwen2-VL, we can send multiple images in a single message
-        # Process first image (can be extended for multi-page documents)
-        response = ollama.chat(
-            model="qwen3-vl",
-            messages=[{
-                "role": "user",
-                "content": prompt,
-                "images": images[:1]  # Send first image, can extend for multi-page
-            }]
-        )
+        # The client is synchronous, so the call runs in a worker thread;
+        # the semaphore queues requests beyond what the model server can take
+        async with _llm_semaphore:
+            response = await asyncio.to_thread(
+                ollama.chat,
+                model=OLLAMA_MODEL,
+                messages=[{
+                    "role": "user",
+                    "content": prompt,
+                    "images": sent_images
+                }]
+            )
         
         text = response["message"]["content"]
         extracted = parse_json_response(text)
@@ -99,7 +205,7 @@ async def ollama_extract(images: List[str], prompt: str = EXTRACTION_PROMPT) ->
         # Calculate confidence
         confidence = calculate_confidence(extracted)
         
-        return {
+        result = {
             "data": extracted,
             "confidence": confidence,
             "provider": "ollama"
@@ -109,26 +215,40 @@ async def ollama_extract(images: List[str], prompt: str = EXTRACTION_PROMPT) ->
         if "model" in str(e).lower() or "not found" in str(e).lower():
             raise ValueError(f"Ollama model 'qwen3-vl' not found. Please run: ollama pull qwen3-vl")
         raise ValueError(f"Ollama extraction failed: {e}")
+    
+    if cache_key is not None:
+        _LLM_CACHE[cache_key] = result
+    return result
 
 
 async def extract_document(
-    file_bytes: bytes,
-    filename: str
+    source: Union[bytes, Path],
+    filename: str,
+    doc_hash: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Extract document data using local Ollama
     
     Args:
-        file_bytes: Raw file bytes
+        source: Raw file bytes, or path to the spooled upload
         filename: Original filename
+        doc_hash: Hash of file_bytes, if already computed
     
     Returns:
         Dict with extracted data, confidence, and provider
     """
-    from .pdf_parser import parse_document
+    from .pdf_parser import parse_document_cached
     
-    # Parse document to get images
-    parsed = parse_document(file_bytes, filename, strategy="vision")
+    # Parse document to get images; rendering is blocking, so keep it off
+    # the event loop. Pages past what ollama_extract sends aren't rendered
+    parsed = await asyncio.to_thread(
+        parse_document_cached,
+        source,
+        filename,
+        strategy="vision",
+        doc_hash=doc_hash,
+        max_pages=OLLAMA_MAX_IMAGES
+    )
     
     if not parsed.get("images"):
         raise ValueError("No images extracted from document")
@@ -1,28 +1,61 @@
 """FastAPI backend for document extraction"""
 import os
 import uuid
-import io
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from datetime import datetime
+from pathlib import Path
+import aiofiles.tempfile
+from cachetools.func import ttl_cache
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from typing import Optional, List
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Optional, List, Tuple, Union
 import duckdb
 
 from .database import (
     init_database,
+    DB_POOL_SIZE,
+    create_cursor_pool,
+    pooled_cursor,
+    close_cursor_pool,
     save_extraction,
     get_extraction,
     check_duplicate,
     list_extractions,
-    export_to_csv,
-    generate_doc_hash
+    iter_csv_export,
+    new_doc_hasher,
+    hash_backend_info
 )
 from .extraction import extract_document
+from .pdf_parser import shutdown_process_pool
 from .models import ExtractedData
 
 
 app = FastAPI(title="DocuExtract AI", version="0.1.0")
 
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Allowance for multipart boundaries and part headers around the file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# Larger uploads are spooled to a temp file that the parser reads from disk
+SPOOL_MAX_MEMORY_BYTES = 1024 * 1024
+
+
+# Registered before CORS so CORS wraps it and 413s still carry CORS headers
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject oversize uploads from Content-Length before the body is read"""
+    if request.method == "POST" and request.url.path == "/api/extract":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and \
+                int(content_length) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": "File size exceeds 10MB limit"}
+            )
+    return await call_next(request)
+
+
 # CORS middleware for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -38,44 +71,127 @@ app.add_middleware(
 
 # Initialize database on startup
 db_conn = None
+db_pool = None
+
+
+def _get_db_pool():
+    """Return the cursor pool, creating it for the current connection if needed"""
+    global db_pool
+    if db_pool is None:
+        db_pool = create_cursor_pool(db_conn, DB_POOL_SIZE)
+    return db_pool
+
+
+async def _run_db(func, *args, **kwargs):
+    """
+    Run a blocking database call in the threadpool
+
+    DuckDB connections must not be used from several threads at once, so
+    each call borrows a cursor from a fixed pool on the shared database.
+    """
+    pool = _get_db_pool()
+    
+    def call():
+        with pooled_cursor(pool) as cursor:
+            return func(cursor, *args, **kwargs)
+    
+    return await run_in_threadpool(call)
 
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize database on startup"""
-    global db_conn
+    global db_conn, db_pool
     db_conn = init_database()
+    db_pool = create_cursor_pool(db_conn, DB_POOL_SIZE)
     print("Database initialized")
+    print(f"Document hashing: {hash_backend_info()}")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Close database connection on shutdown"""
-    global db_conn
+    """Close database connection and PDF workers on shutdown"""
+    global db_conn, db_pool
+    if db_pool:
+        close_cursor_pool(db_pool)
+        db_pool = None
     if db_conn:
         db_conn.close()
+    shutdown_process_pool()
+
+
+# Vision models the extractor can use, matched without their ":tag"
+OLLAMA_VISION_MODELS = frozenset({"qwen3-vl", "qwen2-vl"})
+OLLAMA_STATUS_TTL_SECONDS = 30
+
+
+@ttl_cache(maxsize=1, ttl=OLLAMA_STATUS_TTL_SECONDS)
+def _ollama_available() -> bool:
+    """Check whether a supported vision model is pulled (cached briefly)"""
+    try:
+        import ollama
+        models = ollama.list()
+    except Exception:
+        return False
+    
+    # Newer clients report "model", older ones "name"
+    installed = {
+        (model.get("model") or model.get("name") or "").split(":")[0]
+        for model in models.get("models", [])
+    }
+    return not OLLAMA_VISION_MODELS.isdisjoint(installed)
 
 
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint"""
-    status = {
+    return {
         "status": "ok",
-        "ollama_available": False
+        "ollama_available": await run_in_threadpool(_ollama_available)
     }
+
+
+async def _read_upload(file: UploadFile) -> Tuple[Union[bytes, Path], str]:
+    """
+    Read an upload in chunks, hashing as we go
     
-    # Check Ollama availability
+    Returns the document and its hash. Small documents come back as bytes;
+    past SPOOL_MAX_MEMORY_BYTES they're written to a temp file and its path
+    is returned instead (the caller deletes it). Stops as soon as the
+    upload exceeds the size limit.
+    """
+    hasher = new_doc_hasher()
+    buffer = bytearray()
+    spool = None
+    size = 0
     try:
-        import ollama
-        models = ollama.list()
-        status["ollama_available"] = any(
-            "qwen3-vl" in model.get("name", "") or "qwen2-vl" in model.get("name", "") 
-            for model in models.get("models", [])
-        )
-    except Exception:
-        pass
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail="File size exceeds 10MB limit"
+                )
+            hasher.update(chunk)
+            if spool is None and size > SPOOL_MAX_MEMORY_BYTES:
+                spool = await aiofiles.tempfile.NamedTemporaryFile("wb", delete=False)
+                await spool.write(bytes(buffer))
+                buffer = None
+            if spool is None:
+                buffer.extend(chunk)
+            else:
+                await spool.write(chunk)
+        if spool is not None:
+            await spool.close()
+    except BaseException:
+        if spool is not None:
+            await spool.close()
+            os.unlink(spool.name)
+        raise
     
-    return status
+    if spool is None:
+        return bytes(buffer), hasher.hexdigest()
+    return Path(spool.name), hasher.hexdigest()
 
 
 @app.post("/api/extract")
@@ -99,62 +215,64 @@ async def extract_endpoint(file: UploadFile = File(...)):
             detail=f"Unsupported file type: {file.content_type}"
         )
     
-    # Read file bytes
-    file_bytes = await file.read()
-    
-    # Check file size (10MB limit)
-    if len(file_bytes) > 10 * 1024 * 1024:
-        raise HTTPException(
-            status_code=400,
-            detail="File size exceeds 10MB limit"
-        )
-    
-    # Check for duplicates
-    doc_hash = generate_doc_hash(file_bytes)
-    existing = check_duplicate(db_conn, doc_hash)
-    if existing:
+    source, doc_hash = await _read_upload(file)
+    try:
+        # Check for duplicates
+        existing = await _run_db(check_duplicate, doc_hash)
+        if existing:
+            return {
+                "id": existing["id"],
+                "data": existing,
+                "duplicate": True
+            }
+        
+        # Extract data using local Ollama
+        try:
+            result = await extract_document(source, file.filename, doc_hash=doc_hash)
+            extracted_data = result["data"]
+            confidence = result["confidence"]
+            provider = result["provider"]
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Extraction failed: {str(e)}"
+            )
+        
+        # Save to database
+        extraction_id = str(uuid.uuid4())
+        try:
+            stored_id = await _run_db(
+                save_extraction,
+                extraction_id,
+                doc_hash,
+                file.filename,
+                extracted_data,
+                confidence
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to save extraction: {str(e)}"
+            )
+        
+        # A concurrent upload of the same document was saved first
+        if stored_id != extraction_id:
+            return {
+                "id": stored_id,
+                "data": await _run_db(get_extraction, stored_id),
+                "duplicate": True
+            }
+        
         return {
-            "id": existing["id"],
-            "data": existing,
-            "duplicate": True
+            "id": extraction_id,
+            "data": extracted_data,
+            "confidence": confidence,
+            "provider": provider,
+            "duplicate": False
         }
-    
-    # Extract data using local Ollama
-    try:
-        result = await extract_document(file_bytes, file.filename)
-        extracted_data = result["data"]
-        confidence = result["confidence"]
-        provider = result["provider"]
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Extraction failed: {str(e)}"
-        )
-    
-    # Save to database
-    extraction_id = str(uuid.uuid4())
-    try:
-        save_extraction(
-            db_conn,
-            extraction_id,
-            doc_hash,
-            file.filename,
-            extracted_data,
-            confidence
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to save extraction: {str(e)}"
-        )
-    
-    return {
-        "id": extraction_id,
-        "data": extracted_data,
-        "confidence": confidence,
-        "provider": provider,
-        "duplicate": False
-    }
+    finally:
+        if isinstance(source, Path):
+            source.unlink(missing_ok=True)
 
 
 @app.get("/api/extractions")
@@ -164,26 +282,45 @@ async def list_extractions_endpoint(
     vendor: Optional[str] = Query(None, description="Filter by vendor name"),
     doc_type: Optional[str] = Query(None, description="Filter by document type"),
     offset: int = Query(0, ge=0),
-    limit: int = Query(100, ge=1, le=1000)
+    limit: int = Query(100, ge=1, le=1000),
+    cursor_created_at: Optional[datetime] = Query(None, description="createdAt of the last row of the previous page"),
+    cursor_id: Optional[str] = Query(None, description="id of the last row of the previous page"),
+    include_total: bool = Query(False, description="Also count all matching rows")
 ):
     """List extractions with filters and pagination"""
     global db_conn
     
-    extractions, total = list_extractions(
-        db_conn,
+    if bool(cursor_created_at) != bool(cursor_id):
+        raise HTTPException(
+            status_code=400,
+            detail="cursor_created_at and cursor_id must be provided together"
+        )
+    
+    extractions, total = await _run_db(
+        list_extractions,
         date_from=date_from,
         date_to=date_to,
         vendor=vendor,
         doc_type=doc_type,
         offset=offset,
-        limit=limit
+        limit=limit,
+        cursor_created_at=cursor_created_at,
+        cursor_id=cursor_id,
+        include_total=include_total
     )
     
+    # A full page means there may be more rows after the last one
+    next_cursor = None
+    if len(extractions) == limit:
+        last = extractions[-1]
+        next_cursor = {"created_at": last["createdAt"], "id": last["id"]}
+    
     return {
         "extractions": extractions,
         "total": total,
         "offset": offset,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": next_cursor
     }
 
 
@@ -200,9 +337,10 @@ async def export_extractions_endpoint(
         ids = [id.strip() for id in extraction_ids.split(",")]
     
     if format == "csv":
-        csv_bytes = export_to_csv(db_conn, ids)
+        # Starlette iterates sync generators in the threadpool, and the
+        # export opens its own cursor, so this doesn't block the event loop
         return StreamingResponse(
-            io.BytesIO(csv_bytes),
+            iter_csv_export(db_conn, ids),
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=extractions.csv"}
         )
@@ -215,7 +353,7 @@ async def get_extraction_endpoint(extraction_id: str):
     """Get single extraction by ID"""
     global db_conn
     
-    extraction = get_extraction(db_conn, extraction_id)
+    extraction = await _run_db(get_extraction, extraction_id)
     if not extraction:
         raise HTTPException(status_code=404, detail="Extraction not found")
     
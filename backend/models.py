@@ -1,7 +1,7 @@
 """Pydantic models matching TypeScript types"""
 from enum import Enum
 from typing import Optional, List
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from datetime import date
 
 
@@ -14,14 +14,13 @@ class DocumentType(str, Enum):
 
 
 class LineItem(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+    
     description: str
     quantity: float
     unitPrice: float = Field(alias="unitPrice")
     total: float
     sku: Optional[str] = None
-    
-    class Config:
-        populate_by_name = True
 
 
 class ExtractedData(BaseModel):
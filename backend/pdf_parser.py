@@ -1,93 +1,452 @@
-"""PDF parsing utilities using PyMuPDF, pdfplumber, and pdf2image"""
+"""PDF parsing utilities using PyMuPDF and pdfplumber"""
 import io
-from typing import List, Dict, Any, Optional
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple, Union
 from pathlib import Path
 import fitz  # PyMuPDF
 import pdfplumber
-from pdf2image import convert_from_bytes
+import pybase64
+from cachetools import LRUCache
 from PIL import Image
 
+from .database import generate_doc_hash
 
-def detect_file_type(file_bytes: bytes, filename: str) -> str:
-    """Detect if file is PDF or image"""
-    if filename.lower().endswith(('.pdf',)):
+
+# Worker processes for per-page PDF work, and the page count below which
+# work stays in-process
+PDF_WORKERS = min(os.cpu_count() or 1, 4)
+PARALLEL_MIN_PAGES = 4
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+# Documents are passed around as bytes, or as a path to a spooled upload
+# so large files are read on demand instead of held in memory
+PdfSource = Union[bytes, str, Path]
+
+# Longest rendered page side in pixels; large-format pages get a lower DPI
+# than requested, since the vision model downsamples beyond this anyway
+MAX_LONG_SIDE = 2048
+
+PDF_EXTENSIONS = frozenset({'.pdf'})
+IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'})
+# Leading bytes identifying files whose name has no known extension,
+# grouped so each kind is one startswith(tuple) check. BMP's 2-byte "BM"
+# is left out: too many text files start with it
+PDF_MAGIC = (b'%PDF',)
+IMAGE_MAGIC = (b'\x89PNG', b'\xff\xd8\xff', b'GIF87a', b'GIF89a')
+# WebP is a RIFF container: "RIFF", 4 size bytes, then "WEBP"
+WEBP_MAGIC = (b'RIFF', b'WEBP')
+MAGIC_PREFIX_BYTES = 12
+
+# Parsed documents kept by content hash, bounded by the size of their
+# page images and text (one long scanned PDF alone can be 100+ MB)
+PARSE_CACHE_BYTES = 128 * 1024 * 1024
+
+
+def _parse_result_size(result: Dict[str, Any]) -> int:
+    """Approximate bytes held by a parse result (its base64 pages and text)"""
+    return (
+        sum(map(len, result.get("images", ())))
+        + sum(map(len, result.get("text", ())))
+    ) or 1
+
+
+_parse_cache: LRUCache = LRUCache(maxsize=PARSE_CACHE_BYTES, getsizeof=_parse_result_size)
+_parse_cache_lock = threading.Lock()
+
+PNG_COMPRESS_LEVEL = 1
+
+# Encoded formats the vision model accepts as-is (PNG, JPEG)
+PASSTHROUGH_IMAGE_MAGIC = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff')
+
+
+def _open_pdf(source: PdfSource) -> fitz.Document:
+    """Open a PDF from bytes, or from a path without reading it into memory"""
+    if isinstance(source, (str, Path)):
+        return fitz.open(str(source), filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def _plumber_input(source: PdfSource):
+    """pdfplumber.open input for bytes or a path"""
+    if isinstance(source, (str, Path)):
+        return str(source)
+    return io.BytesIO(source)
+
+
+def _read_head(source: PdfSource, size: int = MAGIC_PREFIX_BYTES) -> bytes:
+    """Return the first bytes of the document for magic-number checks"""
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            return f.read(size)
+    return source[:size]
+
+
+@lru_cache(maxsize=1024)
+def _detect_impl(ext: str, head: bytes) -> str:
+    """Classify by extension, then by leading bytes"""
+    if ext in PDF_EXTENSIONS:
         return 'pdf'
-    elif filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    
+    # Check magic bytes
+    if head.startswith(PDF_MAGIC):
+        return 'pdf'
+    if head.startswith(IMAGE_MAGIC) or (
+        head.startswith(WEBP_MAGIC[0]) and head[8:12] == WEBP_MAGIC[1]
+    ):
         return 'image'
-    else:
-        # Check magic bytes
-        if file_bytes.startswith(b'%PDF'):
-            return 'pdf'
-        elif file_bytes.startswith(b'\x89PNG'):
-            return 'image'
-        elif file_bytes.startswith(b'\xff\xd8\xff'):
-            return 'image'
     return 'unknown'
 
 
-def extract_text(pdf_bytes: bytes) -> List[str]:
-    """Extract text from PDF using PyMuPDF (fast)"""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    pages_text = []
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        text = page.get_text()
-        pages_text.append(text)
-    doc.close()
+def detect_file_type(file_bytes: bytes, filename: str) -> str:
+    """Detect if file is PDF or image"""
+    # Memoized on the extension and a short prefix, never the whole payload
+    ext = os.path.splitext(filename)[1].lower()
+    return _detect_impl(ext, bytes(file_bytes[:MAGIC_PREFIX_BYTES]))
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """Return the shared worker pool, starting it on first use"""
+    global _process_pool
+    # Parses run in to_thread workers; without the lock, concurrent first
+    # callers would each start a pool and all but one would leak
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn: forking a server process that holds DuckDB/uvicorn threads is unsafe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+def _discard_process_pool(pool: ProcessPoolExecutor) -> None:
+    """Forget a broken pool so the next caller starts a fresh one"""
+    global _process_pool
+    with _process_pool_lock:
+        # Another caller may already have replaced it
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False)
+
+
+def shutdown_process_pool() -> None:
+    """Stop the worker pool if it was started"""
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _page_ranges(n_pages: int, n_chunks: int) -> List[Tuple[int, int]]:
+    """Split range(n_pages) into at most n_chunks contiguous (start, end) ranges"""
+    n_chunks = max(1, min(n_chunks, n_pages))
+    size, extra = divmod(n_pages, n_chunks)
+    ranges = []
+    start = 0
+    for i in range(n_chunks):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def _use_workers(n_units: int) -> bool:
+    """Whether n_units pages of work are worth dispatching to the worker pool"""
+    return n_units >= PARALLEL_MIN_PAGES and PDF_WORKERS >= 2
+
+
+def _map_page_ranges(func: Callable[..., list], source: PdfSource, n_pages: int, *extra_args: Any) -> list:
+    """
+    Run func(source, start, end, *extra_args) over [0, n_pages), joining the results
+
+    Short jobs are a single in-process call; longer ones are split into
+    contiguous ranges across the worker processes. map() yields in
+    submission order, so the joined results stay in page order.
+
+    A worker that dies (OOM kill, MuPDF crash) leaves its pool permanently
+    broken, so the pool is replaced and the job retried once on a fresh one.
+    """
+    if not _use_workers(n_pages):
+        return func(source, 0, n_pages, *extra_args)
+    
+    ranges = _page_ranges(n_pages, PDF_WORKERS)
+    map_args = [
+        [source] * len(ranges),
+        [start for start, _ in ranges],
+        [end for _, end in ranges],
+        *([arg] * len(ranges) for arg in extra_args)
+    ]
+    for attempt in range(2):
+        pool = _get_process_pool()
+        try:
+            # Drained here: a dead worker surfaces while collecting results
+            chunks = list(pool.map(func, *map_args))
+            break
+        except BrokenProcessPool:
+            _discard_process_pool(pool)
+            if attempt:
+                raise
+    
+    results = []
+    for chunk in chunks:
+        results.extend(chunk)
+    return results
+
+
+def _page_texts(doc: fitz.Document, start: int, end: int) -> List[str]:
+    """Extract text for pages [start, end) into a preallocated list"""
+    pages_text = [""] * (end - start)
+    for page_num in range(start, end):
+        pages_text[page_num - start] = doc[page_num].get_text()
     return pages_text
 
 
-def extract_tables(pdf_bytes: bytes) -> List[Dict[str, Any]]:
-    """Extract tables from PDF using pdfplumber"""
+def _extract_text_range(source: PdfSource, start: int, end: int) -> List[str]:
+    """Extract text for pages [start, end) (module-level so workers can unpickle it)"""
+    doc = _open_pdf(source)
+    try:
+        return _page_texts(doc, start, end)
+    finally:
+        doc.close()
+
+
+def extract_text(source: PdfSource, doc: Optional[fitz.Document] = None) -> List[str]:
+    """
+    Extract text from PDF using PyMuPDF (fast)
+
+    Documents with PARALLEL_MIN_PAGES or more pages are split into
+    contiguous page ranges extracted in worker processes, which sidesteps
+    the GIL around MuPDF; shorter ones aren't worth the dispatch cost.
+    An already-open `doc` for the same source is reused for short documents.
+    """
+    if doc is None:
+        with _open_pdf(source) as own_doc:
+            return extract_text(source, doc=own_doc)
+    
+    n_pages = len(doc)
+    if not _use_workers(n_pages):
+        return _page_texts(doc, 0, n_pages)
+    return _map_page_ranges(_extract_text_range, source, n_pages)
+
+
+def _find_table_pages(doc: fitz.Document) -> List[int]:
+    """Return 1-based numbers of pages with vector drawings (possible table rulings)"""
+    # pdfplumber's default "lines" strategy builds tables from ruling edges,
+    # so a page with no drawn paths has none. Listing paths is a cheap C call;
+    # page.find_tables() runs a full table finder and cost more than it saved
+    return [
+        page.number + 1
+        for page in doc
+        if page.get_drawings()
+    ]
+
+
+def _extract_tables_pages(source: PdfSource, page_numbers: List[int]) -> List[Dict[str, Any]]:
+    """Extract tables from the given 1-based pages (module-level so workers can unpickle it)"""
+    # No laparams: table finding works on raw chars/edges, and layout
+    # analysis would add a pass over every page
     tables = []
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        for page_num, page in enumerate(pdf.pages):
-            page_tables = page.extract_tables()
-            for table in page_tables:
-                tables.append({
-                    "page": page_num + 1,
-                    "table": table
-                })
+    with pdfplumber.open(_plumber_input(source), pages=page_numbers) as pdf:
+        for page in pdf.pages:
+            try:
+                # Ruling with no text in it has nothing to extract; chars are
+                # parsed once and reused by extract_tables
+                if not page.chars:
+                    continue
+                for table in page.extract_tables():
+                    tables.append({
+                        "page": page.page_number,
+                        "table": table
+                    })
+            finally:
+                # Drop the page's parsed objects before moving on, including
+                # pages skipped above (reading chars already parsed them)
+                page.close()
     return tables
 
 
-def pdf_to_images(pdf_bytes: bytes, dpi: int = 200) -> List[Image.Image]:
-    """Convert PDF pages to PIL Images for vision LLM processing"""
+def _extract_tables_range(
+    source: PdfSource,
+    start: int,
+    end: int,
+    page_numbers: List[int]
+) -> List[Dict[str, Any]]:
+    """Extract tables from page_numbers[start:end] (module-level so workers can unpickle it)"""
+    return _extract_tables_pages(source, page_numbers[start:end])
+
+
+def extract_tables(source: PdfSource, doc: Optional[fitz.Document] = None) -> List[Dict[str, Any]]:
+    """
+    Extract tables from PDF using pdfplumber
+
+    Pages are screened for vector drawings first, so pdfplumber (much
+    slower) only parses pages that could have a ruled table. An already-open `doc` for the
+    same source is reused for the screening pass. pdfplumber documents
+    aren't thread-safe, so when PARALLEL_MIN_PAGES or more pages have
+    tables they're split across the worker processes, each opening its own.
+    """
+    if doc is None:
+        with _open_pdf(source) as own_doc:
+            table_pages = _find_table_pages(own_doc)
+    else:
+        table_pages = _find_table_pages(doc)
+    
+    if not table_pages:
+        return []
+    return _map_page_ranges(_extract_tables_range, source, len(table_pages), table_pages)
+
+
+def _page_matrix(page: fitz.Page, dpi: int, max_long_side: int) -> fitz.Matrix:
+    """Scale for rendering at `dpi`, reduced so the longer side fits max_long_side px"""
+    long_side_pt = max(page.rect.width, page.rect.height)
+    zoom = min(dpi / 72, max_long_side / long_side_pt)
+    return fitz.Matrix(zoom, zoom)
+
+
+def _iter_pixmaps(
+    source: PdfSource,
+    dpi: int,
+    max_long_side: int,
+    start: int = 0,
+    end: Optional[int] = None
+) -> Iterator[fitz.Pixmap]:
+    """Render PDF pages [start, end) to RGB pixmaps one at a time"""
     try:
-        images = convert_from_bytes(pdf_bytes, dpi=dpi)
-        return images
+        doc = _open_pdf(source)
     except Exception as e:
         raise ValueError(f"Failed to convert PDF to images: {e}")
+    
+    try:
+        for page in doc.pages(start, end):
+            matrix = _page_matrix(page, dpi, max_long_side)
+            yield page.get_pixmap(matrix=matrix, alpha=False)
+    finally:
+        doc.close()
+
+
+def iter_pdf_images(
+    source: PdfSource,
+    dpi: int = 200,
+    max_long_side: int = MAX_LONG_SIDE
+) -> Iterator[Image.Image]:
+    """Render PDF pages to PIL Images one at a time with PyMuPDF"""
+    for pix in _iter_pixmaps(source, dpi, max_long_side):
+        yield Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        del pix
+
+
+def iter_pdf_page_b64(
+    source: PdfSource,
+    dpi: int = 200,
+    max_long_side: int = MAX_LONG_SIDE,
+    start: int = 0,
+    end: Optional[int] = None
+) -> Iterator[str]:
+    """
+    Render PDF pages straight to base64 PNG strings
+
+    Uses MuPDF's own PNG encoder, so only one page's pixmap is alive at a
+    time and no PIL Image is built.
+    """
+    for pix in _iter_pixmaps(source, dpi, max_long_side, start, end):
+        png_bytes = pix.tobytes("png")
+        del pix
+        yield pybase64.b64encode_as_string(png_bytes)
+
+
+def _render_pages_b64(
+    source: PdfSource,
+    start: int,
+    end: int,
+    dpi: int,
+    max_long_side: int
+) -> List[str]:
+    """Render pages [start, end) to base64 PNGs (module-level so workers can unpickle it)"""
+    return list(iter_pdf_page_b64(source, dpi, max_long_side, start, end))
+
 
+def pdf_pages_to_base64(
+    source: PdfSource,
+    dpi: int = 200,
+    max_long_side: int = MAX_LONG_SIDE,
+    max_pages: Optional[int] = None
+) -> List[str]:
+    """
+    Render PDF pages to base64 PNG strings, in page order
+
+    Only the first `max_pages` pages are rendered when it is given.
+    Rasterizing is CPU-bound, so documents with PARALLEL_MIN_PAGES or more
+    pages are rendered in page ranges across the worker processes. Workers
+    send back the encoded PNGs, which are far smaller than raw pixmaps.
+    """
+    with _open_pdf(source) as doc:
+        n_pages = len(doc)
+    if max_pages is not None:
+        n_pages = min(n_pages, max_pages)
+    return _map_page_ranges(_render_pages_b64, source, n_pages, dpi, max_long_side)
+
+
+def pdf_to_images(
+    source: PdfSource,
+    dpi: int = 200,
+    max_long_side: int = MAX_LONG_SIDE
+) -> List[Image.Image]:
+    """Convert PDF pages to PIL Images for vision LLM processing"""
+    return list(iter_pdf_images(source, dpi=dpi, max_long_side=max_long_side))
+
+
+def image_to_base64(image: Union[Image.Image, bytes]) -> str:
+    """
+    Convert PIL Image to base64 string (pybase64 uses a SIMD encoder)
 
-def image_to_base64(image: Image.Image) -> str:
-    """Convert PIL Image to base64 string"""
-    import base64
+    Bytes are taken to be an already-encoded PNG/JPEG and encoded as-is.
+    """
     from io import BytesIO
     
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return pybase64.b64encode_as_string(image)
+    
+    # The PNG only travels to the local model, so trade size for a much
+    # cheaper DEFLATE pass than the default level 6
     buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_bytes = buffered.getvalue()
-    return base64.b64encode(img_bytes).decode("utf-8")
+    image.save(buffered, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    # getbuffer() encodes straight from the BytesIO without copying it out
+    return pybase64.b64encode_as_string(buffered.getbuffer())
 
 
 def parse_document(
-    file_bytes: bytes,
+    source: PdfSource,
     filename: str,
-    strategy: str = "vision"
+    strategy: str = "vision",
+    include_tables: bool = True,
+    max_pages: Optional[int] = None
 ) -> Dict[str, Any]:
     """
     Parse document and return preprocessed content for LLM
     
     Args:
-        file_bytes: Raw file bytes
+        source: Raw file bytes, or path to the file
         filename: Original filename
         strategy: "text", "vision", or "hybrid"
+        include_tables: Also extract tables for "text"/"hybrid" (the
+            slowest step; skip it when only raw text is needed)
+        max_pages: Render at most this many PDF pages for "vision"/"hybrid"
+            (pages past what the model is sent are wasted work)
     
     Returns:
         Dict with parsed content ready for LLM processing
     """
-    file_type = detect_file_type(file_bytes, filename)
+    file_type = detect_file_type(_read_head(source), filename)
     
     result = {
         "file_type": file_type,
@@ -97,17 +456,70 @@ def parse_document(
     
     if file_type == "pdf":
         if strategy in ("text", "hybrid"):
-            result["text"] = extract_text(file_bytes)
-            result["tables"] = extract_tables(file_bytes)
+            with _open_pdf(source) as doc:
+                result["text"] = extract_text(source, doc=doc)
+                if include_tables:
+                    result["tables"] = extract_tables(source, doc=doc)
         
         if strategy in ("vision", "hybrid"):
-            images = pdf_to_images(file_bytes)
-            result["images"] = [image_to_base64(img) for img in images]
-            result["image_count"] = len(images)
+            result["images"] = pdf_pages_to_base64(source, max_pages=max_pages)
+            result["image_count"] = len(result["images"])
     
     elif file_type == "image":
-        # For images, convert to base64
-        result["images"] = [image_to_base64(Image.open(io.BytesIO(file_bytes)))]
+        # The model needs the whole image, so a spooled one is read back
+        if isinstance(source, (str, Path)):
+            source = Path(source).read_bytes()
+        
+        # PNG/JPEG uploads are sent unchanged; other formats are re-encoded
+        if source.startswith(PASSTHROUGH_IMAGE_MAGIC):
+            result["images"] = [image_to_base64(source)]
+        else:
+            with Image.open(io.BytesIO(source)) as image:
+                result["images"] = [image_to_base64(image)]
         result["image_count"] = 1
     
     return result
+
+
+def parse_document_cached(
+    source: PdfSource,
+    filename: str,
+    strategy: str = "vision",
+    doc_hash: Optional[str] = None,
+    include_tables: bool = True,
+    max_pages: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    parse_document, reusing the result for a recently parsed identical file
+
+    Re-uploads (e.g. retrying after a failed LLM call) skip rendering.
+    Pass `doc_hash` when the caller has already hashed the file.
+    """
+    if doc_hash is None:
+        data = Path(source).read_bytes() if isinstance(source, (str, Path)) else source
+        doc_hash = generate_doc_hash(data)
+    key = (
+        doc_hash,
+        strategy,
+        include_tables,
+        max_pages,
+        detect_file_type(_read_head(source), filename)
+    )
+    
+    with _parse_cache_lock:
+        cached = _parse_cache.get(key)
+    if cached is not None:
+        return {**cached, "filename": filename}
+    
+    result = parse_document(
+        source,
+        filename,
+        strategy=strategy,
+        include_tables=include_tables,
+        max_pages=max_pages
+    )
+    # Larger than the whole cache: LRUCache would refuse it anyway
+    if _parse_result_size(result) <= PARSE_CACHE_BYTES:
+        with _parse_cache_lock:
+            _parse_cache[key] = result
+    return result
@@ -21,11 +21,17 @@ export interface ExtractionListItem {
   createdAt: string | null;
 }
 
+export interface ExtractionCursor {
+  created_at: string;
+  id: string;
+}
+
 export interface ListExtractionsResponse {
   extractions: ExtractionListItem[];
-  total: number;
+  total: number | null;
   offset: number;
   limit: number;
+  next_cursor: ExtractionCursor | null;
 }
 
 /**
@@ -59,6 +65,8 @@ export const listExtractions = async (
     docType?: string;
     offset?: number;
     limit?: number;
+    cursor?: ExtractionCursor;
+    includeTotal?: boolean;
   }
 ): Promise<ListExtractionsResponse> => {
   const params = new URLSearchParams();
@@ -68,6 +76,11 @@ export const listExtractions = async (
   if (filters?.docType) params.append("doc_type", filters.docType);
   if (filters?.offset) params.append("offset", filters.offset.toString());
   if (filters?.limit) params.append("limit", filters.limit.toString());
+  if (filters?.includeTotal) params.append("include_total", "true");
+  if (filters?.cursor) {
+    params.append("cursor_created_at", filters.cursor.created_at);
+    params.append("cursor_id", filters.cursor.id);
+  }
 
   const response = await fetch(`${BACKEND_URL}/api/extractions?${params.toString()}`);
 
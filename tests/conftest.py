@@ -5,12 +5,72 @@ import tempfile
 import shutil
 from pathlib import Path
 import duckdb
+import backend.database
+import backend.extraction
+import backend.pdf_parser
 from backend.database import init_database
 
 
+@pytest.fixture(autouse=True)
+def clear_parse_cache():
+    """Keep parsed documents (including mocked ones) from leaking between tests"""
+    backend.pdf_parser._parse_cache.clear()
+    yield
+    backend.pdf_parser._parse_cache.clear()
+
+
+CANNED_OLLAMA_CONTENT = (
+    '{"documentType": "Invoice", "vendorName": "Test", '
+    '"totalAmount": 100, "date": "2024-01-15"}'
+)
+
+
+class FakeOllama:
+    """Stand-in for ollama.chat that records calls and returns a canned reply"""
+    
+    def __init__(self):
+        self.response = {"message": {"content": CANNED_OLLAMA_CONTENT}}
+        self.error = None
+        self.calls = []
+    
+    def chat(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    """Route ollama.chat to a FakeOllama; set .response or .error per test"""
+    fake = FakeOllama()
+    monkeypatch.setattr(backend.extraction.ollama, "chat", fake.chat)
+    return fake
+
+
+@pytest.fixture
+def fake_parse(monkeypatch):
+    """Make parse_document return one canned page image without rendering"""
+    parsed = {"file_type": "pdf", "images": ["ZmFrZSBpbWFnZQ=="], "image_count": 1}
+    monkeypatch.setattr(backend.pdf_parser, "parse_document", lambda *args, **kwargs: parsed)
+    return parsed
+
+
+@pytest.fixture
+def llm_cache(monkeypatch):
+    """Enable the LLM response cache, starting empty"""
+    monkeypatch.setenv("LLM_CACHE_ENABLED", "1")
+    backend.extraction._LLM_CACHE.clear()
+    yield backend.extraction._LLM_CACHE
+    backend.extraction._LLM_CACHE.clear()
+
+
 @pytest.fixture
 def temp_db():
     """Create a temporary database for testing"""
+    backend.database._extraction_cache.clear()
+    backend.database._count_cache.clear()
+    
     temp_dir = tempfile.mkdtemp()
     db_path = Path(temp_dir) / "test_extractions.duckdb"
     
@@ -60,7 +120,7 @@ def sample_extraction_data():
     }
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_pdf_bytes():
     """Create a minimal PDF for testing"""
     # Minimal valid PDF structure
@@ -88,7 +148,7 @@ startxref
     return pdf_content
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_image_bytes():
     """Create a minimal PNG image for testing"""
     # Minimal valid PNG (1x1 transparent pixel)
@@ -99,3 +159,68 @@ def sample_image_bytes():
         b'\r\n-\xdb\x00\x00\x00\x00IEND\xaeB`\x82'
     )
     return png_content
+
+
+@pytest.fixture(scope="session")
+def sample_multipage_pdf_bytes():
+    """Create a PDF with one line of distinct text on each of 9 pages"""
+    import fitz
+    doc = fitz.open()
+    for page_num in range(9):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page number {page_num + 1}")
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def _draw_table(page, label=""):
+    """Draw a ruled 3x3 table with labelled cells on a fitz page"""
+    x0, y0, width, height = 72, 100, 120, 30
+    for row in range(4):
+        page.draw_line((x0, y0 + row * height), (x0 + 3 * width, y0 + row * height))
+    for col in range(4):
+        page.draw_line((x0 + col * width, y0), (x0 + col * width, y0 + 3 * height))
+    for row in range(3):
+        for col in range(3):
+            page.insert_text(
+                (x0 + col * width + 5, y0 + row * height + 20),
+                f"{label}R{row}C{col}"
+            )
+
+
+@pytest.fixture(scope="session")
+def sample_table_pdf_bytes():
+    """Create a 2-page PDF: plain text, then a ruled 3x3 table"""
+    import fitz
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "No tables here")
+    _draw_table(doc.new_page())
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+@pytest.fixture(scope="session")
+def sample_table_pdf_doc(sample_table_pdf_bytes):
+    """Open sample_table_pdf_bytes once for tests that pass a shared doc"""
+    import fitz
+    doc = fitz.open(stream=sample_table_pdf_bytes, filetype="pdf")
+    yield doc
+    doc.close()
+
+
+@pytest.fixture(scope="session")
+def sample_many_tables_pdf_bytes():
+    """Create a 6-page PDF with a table on every page but the third"""
+    import fitz
+    doc = fitz.open()
+    for page_num in range(1, 7):
+        page = doc.new_page()
+        if page_num == 3:
+            page.insert_text((72, 72), "No tables here")
+        else:
+            _draw_table(page, label=f"P{page_num}")
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
@@ -5,6 +5,7 @@ from backend.main import app
 from unittest.mock import patch, Mock
 import tempfile
 import os
+from datetime import datetime
 
 
 @pytest.fixture
@@ -14,6 +15,7 @@ def client():
     # Mock database initialization
     mock_conn = Mock()
     backend.main.db_conn = mock_conn
+    backend.main.db_pool = None
     
     # Mock database functions
     with patch("backend.main.init_database", return_value=mock_conn):
@@ -21,45 +23,28 @@ def client():
     
     # Cleanup
     backend.main.db_conn = None
+    backend.main.db_pool = None
 
 
 @pytest.fixture
-def sample_pdf_file():
+def sample_pdf_file(sample_pdf_bytes):
     """Create a sample PDF file for upload"""
-    pdf_content = b"""%PDF-1.4
-1 0 obj
-<< /Type /Catalog /Pages 2 0 R >>
-endobj
-2 0 obj
-<< /Type /Pages /Kids [3 0 R] /Count 1 >>
-endobj
-3 0 obj
-<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>
-endobj
-xref
-0 4
-0000000000 65535 f 
-0000000009 00000 n 
-0000000058 00000 n 
-0000000115 00000 n 
-trailer
-<< /Size 4 /Root 1 0 R >>
-startxref
-179
-%%EOF"""
-    return ("test.pdf", pdf_content, "application/pdf")
+    return ("test.pdf", sample_pdf_bytes, "application/pdf")
 
 
 @pytest.fixture
-def sample_image_file():
+def sample_image_file(sample_image_bytes):
     """Create a sample image file for upload"""
-    png_content = (
-        b'\x89PNG\r\n\x1a\n'
-        b'\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00'
-        b'\x1f\x15\xc4\x89\x00\x00\x00\nIDATx\x9cc\x00\x01\x00\x00\x05\x00\x01'
-        b'\r\n-\xdb\x00\x00\x00\x00IEND\xaeB`\x82'
-    )
-    return ("test.png", png_content, "image/png")
+    return ("test.png", sample_image_bytes, "image/png")
+
+
+@pytest.fixture(autouse=True)
+def clear_ollama_status():
+    """Reset the cached Ollama availability between tests"""
+    import backend.main
+    backend.main._ollama_available.cache_clear()
+    yield
+    backend.main._ollama_available.cache_clear()
 
 
 def test_health_check(client):
@@ -74,6 +59,25 @@ def test_health_check(client):
         assert "gemini_available" not in data
 
 
+def test_health_check_tagged_model(client):
+    """Test newer clients' tagged model names are recognised"""
+    import ollama
+    with patch.object(ollama, "list", return_value={"models": [{"model": "qwen3-vl:latest"}]}):
+        response = client.get("/api/health")
+        assert response.json()["ollama_available"] is True
+
+
+def test_health_check_cached(client):
+    """Test Ollama is only queried once within the cache TTL"""
+    import ollama
+    with patch.object(ollama, "list", return_value={"models": []}) as mock_list:
+        client.get("/api/health")
+        response = client.get("/api/health")
+        
+        assert response.json()["ollama_available"] is False
+        assert mock_list.call_count == 1
+
+
 def test_extract_endpoint_success(client, sample_pdf_file):
     """Test successful extraction endpoint"""
     filename, content, content_type = sample_pdf_file
@@ -93,8 +97,11 @@ def test_extract_endpoint_success(client, sample_pdf_file):
         "provider": "ollama"
     }
     
+    def save(conn, extraction_id, *args, **kwargs):
+        return extraction_id
+    
     with patch("backend.main.extract_document", return_value=mock_result):
-        with patch("backend.main.save_extraction"):
+        with patch("backend.main.save_extraction", side_effect=save):
             with patch("backend.main.check_duplicate", return_value=None):
                 files = {"file": (filename, content, content_type)}
                 response = client.post("/api/extract", files=files)
@@ -104,6 +111,32 @@ def test_extract_endpoint_success(client, sample_pdf_file):
                 assert "id" in data
                 assert data["data"]["vendorName"] == "Test Vendor"
                 assert data["provider"] == "ollama"
+                assert data["duplicate"] is False
+
+
+def test_extract_endpoint_concurrent_duplicate(client, sample_pdf_file):
+    """Test a document saved by a concurrent request is reported as duplicate"""
+    filename, content, content_type = sample_pdf_file
+    
+    mock_result = {
+        "data": {"vendorName": "Test Vendor"},
+        "confidence": 0.9,
+        "provider": "ollama"
+    }
+    existing_extraction = {"id": "existing-id", "vendorName": "Existing Vendor"}
+    
+    with patch("backend.main.extract_document", return_value=mock_result):
+        with patch("backend.main.save_extraction", return_value="existing-id"):
+            with patch("backend.main.check_duplicate", return_value=None):
+                with patch("backend.main.get_extraction", return_value=existing_extraction):
+                    files = {"file": (filename, content, content_type)}
+                    response = client.post("/api/extract", files=files)
+                    
+                    assert response.status_code == 200
+                    data = response.json()
+                    assert data["duplicate"] is True
+                    assert data["id"] == "existing-id"
+                    assert data["data"]["vendorName"] == "Existing Vendor"
 
 
 def test_extract_endpoint_invalid_file_type(client):
@@ -121,10 +154,65 @@ def test_extract_endpoint_file_too_large(client):
     files = {"file": ("test.pdf", large_content, "application/pdf")}
     response = client.post("/api/extract", files=files)
     
-    assert response.status_code == 400
+    assert response.status_code == 413
     assert "10MB" in response.json()["detail"]
 
 
+def test_extract_endpoint_file_just_over_limit(client):
+    """Test a file within the multipart allowance is still rejected while reading"""
+    large_content = b"x" * (10 * 1024 * 1024 + 1)
+    files = {"file": ("test.pdf", large_content, "application/pdf")}
+    
+    with patch("backend.main.check_duplicate") as mock_check:
+        response = client.post("/api/extract", files=files)
+        
+        assert response.status_code == 413
+        assert "10MB" in response.json()["detail"]
+        mock_check.assert_not_called()
+
+
+def test_extract_endpoint_hashes_upload(client, sample_pdf_file):
+    """Test the chunked upload is hashed like the whole file"""
+    from backend.database import generate_doc_hash
+    filename, content, content_type = sample_pdf_file
+    
+    with patch("backend.main.check_duplicate", return_value={"id": "existing-id"}) as mock_check:
+        files = {"file": (filename, content, content_type)}
+        response = client.post("/api/extract", files=files)
+        
+        assert response.status_code == 200
+        assert mock_check.call_args.args[1] == generate_doc_hash(content)
+
+
+def test_extract_endpoint_spools_large_upload(client):
+    """Test large uploads reach the extractor as a temp file removed afterwards"""
+    from pathlib import Path
+    from backend.database import generate_doc_hash
+    content = b"%PDF-1.4 " + b"x" * (3 * 1024 * 1024)
+    seen = {}
+    
+    async def extract(source, filename, doc_hash=None):
+        seen["source"] = source
+        seen["content"] = Path(source).read_bytes()
+        seen["doc_hash"] = doc_hash
+        return {"data": {}, "confidence": 0.5, "provider": "ollama"}
+    
+    def save(conn, extraction_id, *args, **kwargs):
+        return extraction_id
+    
+    with patch("backend.main.extract_document", side_effect=extract):
+        with patch("backend.main.save_extraction", side_effect=save):
+            with patch("backend.main.check_duplicate", return_value=None):
+                files = {"file": ("big.pdf", content, "application/pdf")}
+                response = client.post("/api/extract", files=files)
+    
+    assert response.status_code == 200
+    assert isinstance(seen["source"], Path)
+    assert seen["content"] == content
+    assert seen["doc_hash"] == generate_doc_hash(content)
+    assert not seen["source"].exists()
+
+
 def test_extract_endpoint_duplicate(client, sample_pdf_file):
     """Test extraction endpoint with duplicate document"""
     filename, content, content_type = sample_pdf_file
@@ -159,10 +247,14 @@ def test_list_extractions_endpoint(client):
         }
     ]
     
-    with patch("backend.main.list_extractions", return_value=(mock_extractions, 1)):
+    with patch("backend.main.list_extractions", return_value=(mock_extractions, 1)) as mock_list:
         response = client.get("/api/extractions")
         
         assert response.status_code == 200
+        # Runs on a pooled cursor, not the shared connection
+        import backend.main
+        assert mock_list.call_args.args[0] is backend.main.db_conn.cursor.return_value
+        assert backend.main.db_pool.qsize() == backend.main.DB_POOL_SIZE
         data = response.json()
         assert "extractions" in data
         assert "total" in data
@@ -177,6 +269,51 @@ def test_list_extractions_with_filters(client):
         assert response.status_code == 200
 
 
+def test_list_extractions_include_total(client):
+    """Test the total count is only requested when asked for"""
+    with patch("backend.main.list_extractions", return_value=([], None)) as mock_list:
+        response = client.get("/api/extractions")
+        assert response.json()["total"] is None
+        assert mock_list.call_args.kwargs["include_total"] is False
+        
+        client.get("/api/extractions?include_total=true")
+        assert mock_list.call_args.kwargs["include_total"] is True
+
+
+def test_list_extractions_next_cursor(client):
+    """Test a full page returns a cursor for the next page"""
+    mock_extractions = [
+        {"id": "2", "createdAt": "2024-01-16T10:00:00"},
+        {"id": "1", "createdAt": "2024-01-15T10:00:00"}
+    ]
+    
+    with patch("backend.main.list_extractions", return_value=(mock_extractions, 3)) as mock_list:
+        response = client.get(
+            "/api/extractions?limit=2&cursor_created_at=2024-01-17T10:00:00&cursor_id=3"
+        )
+        
+        assert response.status_code == 200
+        assert response.json()["next_cursor"] == {"created_at": "2024-01-15T10:00:00", "id": "1"}
+        assert mock_list.call_args.kwargs["cursor_id"] == "3"
+        assert mock_list.call_args.kwargs["cursor_created_at"] == datetime(2024, 1, 17, 10, 0)
+
+
+def test_list_extractions_partial_cursor(client):
+    """Test cursor params must be provided together"""
+    response = client.get("/api/extractions?cursor_id=1")
+    
+    assert response.status_code == 400
+
+
+def test_list_extractions_invalid_cursor(client):
+    """Test a malformed cursor timestamp is rejected before querying"""
+    with patch("backend.main.list_extractions") as mock_list:
+        response = client.get("/api/extractions?cursor_created_at=garbage&cursor_id=1")
+        
+        assert response.status_code == 422
+        mock_list.assert_not_called()
+
+
 def test_get_extraction_endpoint(client):
     """Test get single extraction endpoint"""
     mock_extraction = {
@@ -214,10 +351,10 @@ def test_export_extractions_endpoint(client):
     db_conn = db_module.init_database()
     backend.main.db_conn = db_conn
     
-    # Mock export_to_csv to return test data
-    original_func = db_module.export_to_csv
-    db_module.export_to_csv = Mock(return_value=csv_content)
-    backend.main.export_to_csv = Mock(return_value=csv_content)
+    # Mock iter_csv_export to stream test data
+    original_func = db_module.iter_csv_export
+    db_module.iter_csv_export = Mock(return_value=iter([csv_content]))
+    backend.main.iter_csv_export = Mock(return_value=iter([csv_content]))
     
     try:
         response = client.get("/api/extractions/export?format=csv")
@@ -225,9 +362,10 @@ def test_export_extractions_endpoint(client):
         assert response.status_code == 200
         assert "text/csv" in response.headers["content-type"]
         assert "attachment" in response.headers["content-disposition"]
+        assert response.content == csv_content
     finally:
-        db_module.export_to_csv = original_func
-        backend.main.export_to_csv = original_func
+        db_module.iter_csv_export = original_func
+        backend.main.iter_csv_export = original_func
         if db_conn:
             db_conn.close()
 
@@ -244,16 +382,17 @@ def test_export_extractions_with_ids(client):
     backend.main.db_conn = db_conn
     
     # Mock export function
-    original_func = db_module.export_to_csv
-    db_module.export_to_csv = Mock(return_value=csv_content)
-    backend.main.export_to_csv = Mock(return_value=csv_content)
+    original_func = db_module.iter_csv_export
+    db_module.iter_csv_export = Mock(return_value=iter([csv_content]))
+    backend.main.iter_csv_export = Mock(return_value=iter([csv_content]))
     
     try:
         response = client.get("/api/extractions/export?format=csv&extraction_ids=1,2")
         
         assert response.status_code == 200
+        assert backend.main.iter_csv_export.call_args.args[1] == ["1", "2"]
     finally:
-        db_module.export_to_csv = original_func
-        backend.main.export_to_csv = original_func
+        db_module.iter_csv_export = original_func
+        backend.main.iter_csv_export = original_func
         if db_conn:
             db_conn.close()
@@ -1,13 +1,20 @@
 """Tests for database module"""
 import pytest
 import uuid
+from datetime import datetime
 from backend.database import (
+    create_cursor_pool,
+    pooled_cursor,
+    close_cursor_pool,
     save_extraction,
     get_extraction,
     check_duplicate,
     list_extractions,
     export_to_csv,
-    generate_doc_hash
+    iter_csv_export,
+    generate_doc_hash,
+    new_doc_hasher,
+    hash_backend_info
 )
 
 
@@ -18,8 +25,32 @@ def test_generate_doc_hash():
     hash2 = generate_doc_hash(file_bytes)
     
     assert hash1 == hash2
-    assert len(hash1) == 64  # SHA-256 hex length
+    assert len(hash1) == 64  # 256-bit BLAKE3 hex length
     assert isinstance(hash1, str)
+    assert generate_doc_hash(b"") == "af1349b9f5f9a1a6a0404dea36dcc9499bcb25c9adc112b7cc9a93cae41f3262"
+
+
+def test_new_doc_hasher_matches_generate_doc_hash():
+    """Test incremental hashing matches one-shot hashing"""
+    file_bytes = b"chunked " * 1000
+    hasher = new_doc_hasher()
+    for start in range(0, len(file_bytes), 333):
+        hasher.update(file_bytes[start:start + 333])
+    
+    assert hasher.hexdigest() == generate_doc_hash(file_bytes)
+
+
+def test_generate_doc_hash_large_input():
+    """Test multithreaded hashing of a large input matches the serial digest"""
+    import blake3
+    file_bytes = bytes(range(256)) * (16 * 1024)  # 4 MiB
+    
+    assert generate_doc_hash(file_bytes) == blake3.blake3(file_bytes).hexdigest()
+
+
+def test_hash_backend_info():
+    """Test hash backend description names the algorithm"""
+    assert hash_backend_info().startswith("blake3")
 
 
 def test_save_extraction(temp_db, sample_extraction_data):
@@ -47,6 +78,38 @@ def test_save_extraction(temp_db, sample_extraction_data):
     assert len(extraction["lineItems"]) == 2
 
 
+def test_save_extraction_raw_json(temp_db, sample_extraction_data):
+    """Test the full payload is stored as queryable JSON"""
+    extraction_id = str(uuid.uuid4())
+    save_extraction(temp_db, extraction_id, generate_doc_hash(b"raw"), "a.pdf", sample_extraction_data)
+    
+    vendor, items = temp_db.execute("""
+        SELECT raw_json->>'vendorName', json_array_length(raw_json->'lineItems')
+        FROM extractions WHERE id = ?
+    """, [extraction_id]).fetchone()
+    
+    assert vendor == "Test Vendor Inc."
+    assert items == 2
+
+
+def test_save_extraction_rolls_back_on_failure(temp_db, sample_extraction_data):
+    """Test a failing line item insert leaves no partial extraction behind"""
+    extraction_id = str(uuid.uuid4())
+    data = sample_extraction_data.copy()
+    data["lineItems"] = [{"description": "Bad", "quantity": "not a number"}]
+
+    with pytest.raises(Exception):
+        save_extraction(
+            temp_db,
+            extraction_id,
+            generate_doc_hash(b"rollback test"),
+            "bad.pdf",
+            data
+        )
+
+    assert get_extraction(temp_db, extraction_id) is None
+
+
 def test_get_extraction(temp_db, sample_extraction_data):
     """Test retrieving extraction from database"""
     extraction_id = str(uuid.uuid4())
@@ -75,6 +138,31 @@ def test_get_extraction(temp_db, sample_extraction_data):
     assert extraction["lineItems"][0]["quantity"] == 2.0
 
 
+def test_get_extraction_without_line_items(temp_db, sample_extraction_data):
+    """Test an extraction with no line items returns an empty list"""
+    extraction_id = str(uuid.uuid4())
+    data = sample_extraction_data.copy()
+    data["lineItems"] = []
+    save_extraction(temp_db, extraction_id, generate_doc_hash(b"no items"), "a.pdf", data)
+    
+    extraction = get_extraction(temp_db, extraction_id)
+    
+    assert extraction["vendorName"] == "Test Vendor Inc."
+    assert extraction["lineItems"] == []
+
+
+def test_get_extraction_cached(temp_db, sample_extraction_data):
+    """Test repeat reads are served from the cache without querying"""
+    extraction_id = str(uuid.uuid4())
+    save_extraction(temp_db, extraction_id, generate_doc_hash(b"cache"), "a.pdf", sample_extraction_data)
+    
+    first = get_extraction(temp_db, extraction_id)
+    temp_db.execute("DELETE FROM line_items")
+    temp_db.execute("DELETE FROM extractions")
+    
+    assert get_extraction(temp_db, extraction_id) is first
+
+
 def test_get_extraction_not_found(temp_db):
     """Test retrieving non-existent extraction"""
     extraction = get_extraction(temp_db, "non-existent-id")
@@ -148,6 +236,55 @@ def test_list_extractions(temp_db, sample_extraction_data):
     assert total == 5
 
 
+def test_list_extractions_total(temp_db, sample_extraction_data):
+    """Test the total can be skipped, is cached, and refreshes on save"""
+    save_extraction(temp_db, str(uuid.uuid4()), generate_doc_hash(b"count0"), "a.pdf", sample_extraction_data)
+    
+    extractions, total = list_extractions(temp_db, include_total=False)
+    assert len(extractions) == 1
+    assert total is None
+    
+    assert list_extractions(temp_db)[1] == 1
+    
+    # Rows written behind the cache's back aren't counted until it expires
+    temp_db.execute("UPDATE extractions SET vendor_name = 'Other'")
+    assert list_extractions(temp_db, vendor="Test Vendor")[1] == 0
+    assert list_extractions(temp_db)[1] == 1
+    
+    save_extraction(temp_db, str(uuid.uuid4()), generate_doc_hash(b"count1"), "b.pdf", sample_extraction_data)
+    assert list_extractions(temp_db)[1] == 2
+
+
+def test_list_extractions_keyset_pagination(temp_db, sample_extraction_data):
+    """Test walking pages with a (createdAt, id) cursor"""
+    for i in range(5):
+        save_extraction(
+            temp_db,
+            str(uuid.uuid4()),
+            generate_doc_hash(f"cursor{i}".encode()),
+            f"file{i}.pdf",
+            sample_extraction_data,
+            confidence=0.9
+        )
+    
+    all_rows, _ = list_extractions(temp_db)
+    
+    seen = []
+    cursor = {}
+    while True:
+        page, total = list_extractions(temp_db, limit=2, **cursor)
+        assert total == 5
+        if not page:
+            break
+        seen.extend(row["id"] for row in page)
+        cursor = {
+            "cursor_created_at": datetime.fromisoformat(page[-1]["createdAt"]),
+            "cursor_id": page[-1]["id"]
+        }
+    
+    assert seen == [row["id"] for row in all_rows]
+
+
 def test_export_to_csv(temp_db, sample_extraction_data):
     """Test CSV export functionality"""
     # Create test extractions
@@ -181,3 +318,88 @@ def test_export_to_csv(temp_db, sample_extraction_data):
     csv_bytes_all = export_to_csv(temp_db)
     csv_text_all = csv_bytes_all.decode("utf-8")
     assert "INV-002" in csv_text_all
+
+
+def test_iter_csv_export_chunks(temp_db, sample_extraction_data):
+    """Test streamed CSV export is chunked and quotes commas and quotes"""
+    data = sample_extraction_data.copy()
+    data["summary"] = 'Consulting, "design" and review'
+    save_extraction(temp_db, str(uuid.uuid4()), generate_doc_hash(b"csv"), "a.pdf", data)
+    
+    chunks = list(iter_csv_export(temp_db, chunk_size=64))
+    csv_bytes = b"".join(chunks)
+    
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 64 for chunk in chunks)
+    assert csv_bytes.startswith(b"id,filename,document_type")
+    assert b'"Consulting, ""design"" and review"' in csv_bytes
+
+
+def test_iter_csv_export_empty(temp_db):
+    """Test exporting an empty database yields only the header"""
+    chunks = list(iter_csv_export(temp_db))
+    
+    assert chunks == [b"id,filename,document_type,vendor_name,total_amount,currency,date,invoice_number,tax_amount,summary,line_description,line_quantity,line_unit_price,line_total,line_sku\n"]
+
+
+def test_save_extraction_duplicate_hash(temp_db, sample_extraction_data):
+    """Test saving an already stored document returns the existing id"""
+    doc_hash = generate_doc_hash(b"unique test")
+    first_id = str(uuid.uuid4())
+    save_extraction(temp_db, first_id, doc_hash, "a.pdf", sample_extraction_data)
+    
+    second_id = str(uuid.uuid4())
+    result_id = save_extraction(temp_db, second_id, doc_hash, "b.pdf", sample_extraction_data)
+    
+    assert result_id == first_id
+    assert get_extraction(temp_db, second_id) is None
+    assert len(get_extraction(temp_db, first_id)["lineItems"]) == 2
+
+
+def test_save_extraction_overlapping_duplicate(temp_db, sample_extraction_data, monkeypatch):
+    """Test a save that loses a commit race on doc_hash returns the winner's id"""
+    import backend.database
+    doc_hash = generate_doc_hash(b"overlapping")
+    first, second = temp_db.cursor(), temp_db.cursor()
+    first_id = str(uuid.uuid4())
+    second_id = str(uuid.uuid4())
+    
+    # First request inserts but hasn't committed yet
+    first.execute("BEGIN TRANSACTION")
+    backend.database._insert_extraction(
+        first, first_id, doc_hash, "a.pdf", sample_extraction_data, 1.0
+    )
+    
+    # Second request's INSERT can't see it, then the first commits before
+    # the second does
+    original_insert = backend.database._insert_extraction
+    
+    def insert_then_first_commits(*args, **kwargs):
+        inserted = original_insert(*args, **kwargs)
+        first.execute("COMMIT")
+        return inserted
+    
+    monkeypatch.setattr(backend.database, "_insert_extraction", insert_then_first_commits)
+    result_id = save_extraction(second, second_id, doc_hash, "b.pdf", sample_extraction_data)
+    
+    assert result_id == first_id
+    assert get_extraction(temp_db, second_id) is None
+    assert temp_db.execute(
+        "SELECT COUNT(*) FROM line_items WHERE extraction_id = ?", [second_id]
+    ).fetchone()[0] == 0
+
+
+def test_cursor_pool(temp_db, sample_extraction_data):
+    """Test pooled cursors see the shared database and are returned"""
+    extraction_id = str(uuid.uuid4())
+    save_extraction(temp_db, extraction_id, generate_doc_hash(b"pool"), "a.pdf", sample_extraction_data)
+    pool = create_cursor_pool(temp_db, size=2)
+    
+    with pooled_cursor(pool) as cursor:
+        assert pool.qsize() == 1
+        extractions, total = list_extractions(cursor)
+        assert total == 1
+    
+    assert pool.qsize() == 2
+    close_cursor_pool(pool)
+    assert pool.empty()
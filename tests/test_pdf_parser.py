@@ -26,6 +26,16 @@ def test_detect_file_type_image():
     
     jpeg_bytes = b"\xff\xd8\xff"
     assert detect_file_type(jpeg_bytes, "test.jpeg") == "image"
+    assert detect_file_type(jpeg_bytes, "scan") == "image"  # Magic bytes
+    assert detect_file_type(png_bytes, "photo.v2.WebP") == "image"
+
+
+def test_detect_file_type_image_magic():
+    """Test GIF and WebP are recognised without an extension"""
+    assert detect_file_type(b"GIF89a\x01\x00", "upload") == "image"
+    assert detect_file_type(b"RIFF\x24\x00\x00\x00WEBPVP8 ", "upload") == "image"
+    assert detect_file_type(b"RIFF\x24\x00\x00\x00WAVEfmt ", "upload") == "unknown"
+    assert detect_file_type(b"BMW invoice", "upload") == "unknown"
 
 
 def test_detect_file_type_unknown():
@@ -44,6 +54,82 @@ def test_extract_text(sample_pdf_bytes):
         pytest.skip(f"PDF text extraction failed (may need valid PDF): {e}")
 
 
+def test_extract_text_parallel(sample_multipage_pdf_bytes, monkeypatch):
+    """Test multi-page extraction across workers keeps page order"""
+    from backend import pdf_parser
+    from backend.pdf_parser import _extract_text_range
+    
+    monkeypatch.setattr(pdf_parser, "PDF_WORKERS", 2)
+    pages_text = extract_text(sample_multipage_pdf_bytes)
+    
+    assert len(pages_text) == 9
+    assert pages_text == _extract_text_range(sample_multipage_pdf_bytes, 0, 9)
+    for page_num, text in enumerate(pages_text):
+        assert f"Page number {page_num + 1}" in text
+
+
+def test_get_process_pool_concurrent_first_use(monkeypatch):
+    """Test concurrent first callers share one pool instead of each starting one"""
+    import threading
+    import time
+    from backend import pdf_parser
+    
+    created = []
+    
+    def slow_pool(**kwargs):
+        time.sleep(0.01)
+        created.append(object())
+        return created[-1]
+    
+    monkeypatch.setattr(pdf_parser, "_process_pool", None)
+    monkeypatch.setattr(pdf_parser, "ProcessPoolExecutor", slow_pool)
+    
+    pools = []
+    barrier = threading.Barrier(8)
+    
+    def worker():
+        barrier.wait()
+        pools.append(pdf_parser._get_process_pool())
+    
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len(created) == 1
+    assert all(pool is created[0] for pool in pools)
+
+
+def test_extract_text_recovers_from_dead_worker(sample_multipage_pdf_bytes, monkeypatch):
+    """Test a killed worker doesn't leave the shared pool broken for later parses"""
+    import os
+    import signal
+    import time
+    from backend import pdf_parser
+    
+    monkeypatch.setattr(pdf_parser, "PDF_WORKERS", 2)
+    expected = extract_text(sample_multipage_pdf_bytes)
+    
+    pool = pdf_parser._process_pool
+    os.kill(next(iter(pool._processes)), signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while not pool._broken and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool._broken
+    
+    assert extract_text(sample_multipage_pdf_bytes) == expected
+    assert pdf_parser._process_pool is not pool
+
+
+def test_page_ranges():
+    """Test page ranges are contiguous and cover every page"""
+    from backend.pdf_parser import _page_ranges
+    
+    assert _page_ranges(9, 4) == [(0, 3), (3, 5), (5, 7), (7, 9)]
+    assert _page_ranges(2, 4) == [(0, 1), (1, 2)]
+
+
 def test_extract_tables(sample_pdf_bytes):
     """Test table extraction from PDF"""
     try:
@@ -54,14 +140,138 @@ def test_extract_tables(sample_pdf_bytes):
         pytest.skip(f"PDF table extraction failed: {e}")
 
 
+def test_extract_tables_screens_pages(sample_table_pdf_bytes):
+    """Test only pages with ruling drawn on them are parsed, keeping page numbers"""
+    tables = extract_tables(sample_table_pdf_bytes)
+    
+    assert len(tables) == 1
+    assert tables[0]["page"] == 2
+    assert tables[0]["table"][0] == ["R0C0", "R0C1", "R0C2"]
+
+
+def test_find_table_pages(sample_table_pdf_doc):
+    """Test the screen keeps pages with drawn ruling and skips text-only ones"""
+    from backend.pdf_parser import _find_table_pages
+    
+    assert _find_table_pages(sample_table_pdf_doc) == [2]
+
+
+def test_extract_tables_pages_closes_skipped_pages(sample_table_pdf_bytes, monkeypatch):
+    """Test every page is closed, including ones skipped for having no text"""
+    import fitz
+    import pdfplumber
+    from backend.pdf_parser import _extract_tables_pages
+    
+    doc = fitz.open(stream=sample_table_pdf_bytes, filetype="pdf")
+    doc.new_page().draw_line((72, 72), (300, 72))
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    
+    closed = []
+    original_close = pdfplumber.page.Page.close
+    
+    def recording_close(page):
+        closed.append(page.page_number)
+        original_close(page)
+    
+    monkeypatch.setattr(pdfplumber.page.Page, "close", recording_close)
+    tables = _extract_tables_pages(pdf_bytes, [2, 3])
+    
+    assert [table["page"] for table in tables] == [2]
+    # Closing the document closes every page again afterwards
+    assert closed[:2] == [2, 3]
+
+
+def test_extract_with_shared_doc(sample_table_pdf_bytes, sample_table_pdf_doc):
+    """Test passing an already-open document gives the same results"""
+    assert extract_text(sample_table_pdf_bytes, doc=sample_table_pdf_doc) == \
+        extract_text(sample_table_pdf_bytes)
+    assert extract_tables(sample_table_pdf_bytes, doc=sample_table_pdf_doc) == \
+        extract_tables(sample_table_pdf_bytes)
+
+
+def test_extract_tables_parallel(sample_many_tables_pdf_bytes, monkeypatch):
+    """Test tables extracted across workers match serial extraction, in page order"""
+    from backend import pdf_parser
+    from backend.pdf_parser import _extract_tables_pages
+    
+    monkeypatch.setattr(pdf_parser, "PDF_WORKERS", 2)
+    tables = extract_tables(sample_many_tables_pdf_bytes)
+    
+    assert [table["page"] for table in tables] == [1, 2, 4, 5, 6]
+    assert tables == _extract_tables_pages(sample_many_tables_pdf_bytes, [1, 2, 4, 5, 6])
+    assert tables[2]["table"][0][0] == "P4R0C0"
+
+
 def test_pdf_to_images(sample_pdf_bytes):
     """Test PDF to image conversion"""
-    try:
-        images = pdf_to_images(sample_pdf_bytes, dpi=100)
-        assert isinstance(images, list)
-        assert len(images) >= 0
-    except Exception as e:
-        pytest.skip(f"PDF to image conversion failed (may need poppler): {e}")
+    images = pdf_to_images(sample_pdf_bytes, dpi=100)
+    assert isinstance(images, list)
+    assert len(images) == 1
+    assert images[0].mode == "RGB"
+
+
+def test_pdf_to_images_dpi(sample_multipage_pdf_bytes):
+    """Test pages are rendered at the requested resolution"""
+    from backend.pdf_parser import iter_pdf_images
+    
+    images = iter_pdf_images(sample_multipage_pdf_bytes, dpi=144)
+    first = next(images)
+    # Default fitz pages are A4, 595x842pt
+    assert first.size == (1190, 1684)
+    assert len(list(images)) == 8
+
+
+def test_pdf_to_images_caps_long_side():
+    """Test oversized pages are rendered below the requested DPI"""
+    import fitz
+    
+    doc = fitz.open()
+    doc.new_page(width=1728, height=2592)  # 24x36in poster
+    doc.new_page()
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    
+    poster, a4 = pdf_to_images(pdf_bytes, dpi=200)
+    
+    assert max(poster.size) <= 2048
+    assert poster.size[1] >= 2047
+    assert max(a4.size) == 2048
+    assert max(pdf_to_images(pdf_bytes, dpi=72, max_long_side=10_000)[0].size) == 2592
+
+
+def test_iter_pdf_page_b64(sample_multipage_pdf_bytes):
+    """Test pages are streamed as base64-encoded PNGs"""
+    import base64
+    from backend.pdf_parser import iter_pdf_page_b64
+    
+    pages = list(iter_pdf_page_b64(sample_multipage_pdf_bytes, dpi=72))
+    
+    assert len(pages) == 9
+    assert base64.b64decode(pages[0]).startswith(b"\x89PNG")
+
+
+def test_pdf_pages_to_base64_parallel(sample_multipage_pdf_bytes, monkeypatch):
+    """Test pages rendered across workers match in-process rendering"""
+    from backend import pdf_parser
+    from backend.pdf_parser import iter_pdf_page_b64, pdf_pages_to_base64
+    
+    monkeypatch.setattr(pdf_parser, "PDF_WORKERS", 2)
+    pages = pdf_pages_to_base64(sample_multipage_pdf_bytes, dpi=72)
+    
+    assert pages == list(iter_pdf_page_b64(sample_multipage_pdf_bytes, dpi=72))
+
+
+def test_pdf_pages_to_base64_max_pages(sample_multipage_pdf_bytes, monkeypatch):
+    """Test only the first max_pages pages are rendered"""
+    from backend import pdf_parser
+    from backend.pdf_parser import iter_pdf_page_b64, pdf_pages_to_base64
+    
+    monkeypatch.setattr(pdf_parser, "PDF_WORKERS", 2)
+    pages = pdf_pages_to_base64(sample_multipage_pdf_bytes, dpi=72, max_pages=5)
+    
+    assert pages == list(iter_pdf_page_b64(sample_multipage_pdf_bytes, dpi=72, end=5))
+    assert len(pdf_pages_to_base64(sample_multipage_pdf_bytes, dpi=72, max_pages=20)) == 9
 
 
 def test_image_to_base64(sample_image_bytes):
@@ -76,6 +286,18 @@ def test_image_to_base64(sample_image_bytes):
     assert len(base64_str) > 0
 
 
+def test_image_to_base64_lossless():
+    """Test the fast PNG encoding round-trips pixels exactly"""
+    import base64
+    import io
+    from PIL import Image
+    
+    img = Image.effect_noise((64, 64), 40).convert("RGB")
+    decoded = Image.open(io.BytesIO(base64.b64decode(image_to_base64(img))))
+    
+    assert decoded.tobytes() == img.tobytes()
+
+
 def test_parse_document_pdf(sample_pdf_bytes):
     """Test document parsing for PDF"""
     result = parse_document(sample_pdf_bytes, "test.pdf", strategy="vision")
@@ -97,6 +319,29 @@ def test_parse_document_image(sample_image_bytes):
     assert result["image_count"] == 1
 
 
+def test_parse_document_image_passthrough(sample_image_bytes):
+    """Test PNG uploads are base64-encoded without re-encoding"""
+    import base64
+    
+    result = parse_document(sample_image_bytes, "test.png", strategy="vision")
+    
+    assert base64.b64decode(result["images"][0]) == sample_image_bytes
+
+
+def test_parse_document_image_converted():
+    """Test formats other than PNG/JPEG are re-encoded as PNG"""
+    import base64
+    import io
+    from PIL import Image
+    
+    buffered = io.BytesIO()
+    Image.new("RGB", (4, 4), "white").save(buffered, format="GIF")
+    
+    result = parse_document(buffered.getvalue(), "test.gif", strategy="vision")
+    
+    assert base64.b64decode(result["images"][0]).startswith(b"\x89PNG")
+
+
 def test_parse_document_text_strategy(sample_pdf_bytes):
     """Test document parsing with text strategy"""
     result = parse_document(sample_pdf_bytes, "test.pdf", strategy="text")
@@ -114,3 +359,70 @@ def test_parse_document_hybrid_strategy(sample_pdf_bytes):
     assert "text" in result
     assert "tables" in result
     assert "images" in result
+
+
+def test_parse_document_cached(sample_image_bytes):
+    """Test identical documents are only parsed once"""
+    from unittest.mock import patch
+    from backend import pdf_parser
+    from backend.pdf_parser import parse_document_cached
+    
+    with patch("backend.pdf_parser.parse_document", wraps=pdf_parser.parse_document) as parse:
+        first = parse_document_cached(sample_image_bytes, "a.png")
+        second = parse_document_cached(sample_image_bytes, "b.png")
+        parse_document_cached(sample_image_bytes, "a.png", strategy="text")
+    
+    assert parse.call_count == 2
+    assert second["images"] == first["images"]
+    assert second["filename"] == "b.png"
+
+
+def test_parse_document_cached_bounded_by_size(monkeypatch):
+    """Test the parse cache evicts by image bytes and skips oversized results"""
+    from cachetools import LRUCache
+    from backend import pdf_parser
+    from backend.pdf_parser import parse_document_cached
+    
+    monkeypatch.setattr(pdf_parser, "PARSE_CACHE_BYTES", 100)
+    monkeypatch.setattr(pdf_parser, "_parse_cache", LRUCache(
+        maxsize=100, getsizeof=pdf_parser._parse_result_size
+    ))
+    sizes = {"a": 60, "b": 60, "big": 150}
+    monkeypatch.setattr(
+        pdf_parser,
+        "parse_document",
+        lambda source, filename, **kwargs: {"images": ["x" * sizes[filename]]}
+    )
+    
+    for name in ("a", "b", "big"):
+        parse_document_cached(b"%PDF", name, doc_hash=name)
+    
+    assert [key[0] for key in pdf_parser._parse_cache] == ["b"]
+    assert pdf_parser._parse_cache.currsize == 60
+
+
+def test_parse_document_from_path(sample_table_pdf_bytes, tmp_path):
+    """Test a document on disk parses the same as its bytes"""
+    path = tmp_path / "upload"
+    path.write_bytes(sample_table_pdf_bytes)
+    
+    from_path = parse_document(path, "upload.pdf", strategy="hybrid")
+    from_bytes = parse_document(sample_table_pdf_bytes, "upload.pdf", strategy="hybrid")
+    
+    assert from_path["text"] == from_bytes["text"]
+    assert from_path["tables"] == from_bytes["tables"]
+    assert from_path["images"] == from_bytes["images"]
+
+
+def test_parse_document_text_without_tables(sample_table_pdf_bytes):
+    """Test table extraction can be skipped for text-only parsing"""
+    from unittest.mock import patch
+    
+    with patch("backend.pdf_parser.extract_tables") as mock_tables:
+        result = parse_document(
+            sample_table_pdf_bytes, "test.pdf", strategy="text", include_tables=False
+        )
+    
+    mock_tables.assert_not_called()
+    assert "tables" not in result
+    assert "R0C0" in result["text"][1]